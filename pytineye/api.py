@@ -8,17 +8,88 @@ Python library to ease communication with the TinEye API server.
 Copyright (c) 2021 TinEye. All rights reserved worldwide.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import http.client
-import json
-import time
+from functools import lru_cache
+import sys
 
 from .api_request import APIRequest
+from .cache import ResponseCache
 from .exceptions import TinEyeAPIError
 
 import certifi
 import urllib3
 
+# Prefer orjson for decoding API responses when it is installed, it parses
+# bytes directly and is considerably faster than the standard library.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Connection pool shared by every TinEyeAPIRequest instance, so keep-alive
+# connections to the API server are reused even when a client is created
+# per thread or per call. Responses are requested gzipped, urllib3 decodes
+# them transparently.
+#
+# Only connections that fail to open are retried, with a short backoff.
+# Anything else would send the same signed request again with the same
+# nonce, and if the server already accepted it the retry is rejected as a
+# replay or counted as a second search. `total` also caps redirects.
+#
+# Up to `maxsize` connections are kept alive per host. This is well above
+# the default worker count of `search_urls_bulk` so concurrent callers don't
+# churn connections. Past it, extra connections are opened rather than
+# blocking and are discarded once done.
+_http_pool = urllib3.PoolManager(
+    headers={"Accept-Encoding": "gzip"},
+    maxsize=50,
+    block=False,
+    cert_reqs="CERT_REQUIRED",
+    ca_certs=certifi.where(),
+    timeout=urllib3.Timeout(connect=15.0, read=60.0),
+    retries=urllib3.Retry(
+        total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.2
+    ),
+)
+
+# HTTP status code and API response code of a successful call
+_HTTP_OK = 200
+
+# Number of seconds image_count responses stay cached
+IMAGE_COUNT_CACHE_TTL = 60
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date_string):
+    """
+    Parse a date in the fixed `YYYY-MM-DD` format used by the API.
+
+    `datetime.fromisoformat` is implemented in C and is much faster than
+    `time.strptime`, which adds up over the backlinks of a large response.
+    Backlinks are crawled in batches so many share the same date, parsed
+    dates are cached.
+
+    - `date_string`, the date string.
+
+    Returns: a datetime object.
+    """
+
+    return datetime.fromisoformat(date_string)
+
+
+@lru_cache(maxsize=256)
+def _parse_utc_datetime(date_string):
+    """
+    Parse a date in the fixed `YYYY-MM-DD HH:MM:SS UTC` format used by the API.
+
+    - `date_string`, the date string.
+
+    Returns: a naive datetime object.
+    """
+
+    return datetime.fromisoformat(date_string[:-4])
+
 
 class TinEyeResponse(object):
     """
@@ -30,16 +101,14 @@ class TinEyeResponse(object):
     - `stats`, stats for this search.
     """
 
+    __slots__ = ("matches", "stats")
+
     def __init__(self, matches, stats):
         self.matches = matches
         self.stats = stats
 
     def __repr__(self):
-        return "%s(matches=%s, stats=%s)" % (
-            self.__class__.__name__,
-            self.matches,
-            self.stats,
-        )
+        return f"{self.__class__.__name__}(matches={self.matches}, stats={self.stats})"
 
     @staticmethod
     def _from_dict(result_json):
@@ -55,17 +124,11 @@ class TinEyeResponse(object):
         if not isinstance(result_json, dict):
             raise TinEyeAPIError("500", ["Please pass in a dictionary to _from_dict()"])
 
-        matches = []
-        stats = {}
-
-        if "results" in result_json:
-            results = result_json["results"]
-            if "matches" in results:
-                for m in results.get("matches"):
-                    match = Match._from_dict(m)
-                    matches.append(match)
-        if "stats" in result_json:
-            stats = result_json["stats"]
+        results = result_json.get("results") or {}
+        # Bound once rather than looked up for each of the (often 100) matches
+        match_from_dict = Match._from_dict
+        matches = [match_from_dict(m) for m in results.get("matches") or ()]
+        stats = result_json.get("stats") or {}
 
         return TinEyeResponse(
             matches=matches,
@@ -93,6 +156,21 @@ class Match(object):
     - `tags`, whether this match belongs to a collection or stock domain.
     """
 
+    __slots__ = (
+        "image_url",
+        "domain",
+        "score",
+        "width",
+        "height",
+        "size",
+        "format",
+        "filesize",
+        "overlay",
+        "tags",
+        "_backlinks",
+        "_backlinks_json",
+    )
+
     def __init__(
         self,
         image_url,
@@ -123,14 +201,31 @@ class Match(object):
             self.tags = tags
 
     def __repr__(self):
-        return '%s(image_url="%s", score=%.2f, width=%i, height=%i)' % (
-            self.__class__.__name__,
-            self.image_url,
-            self.score,
-            self.width,
-            self.height,
+        return (
+            f'{self.__class__.__name__}(image_url="{self.image_url}", '
+            f"score={self.score:.2f}, width={int(self.width)}, "
+            f"height={int(self.height)})"
         )
 
+    @property
+    def backlinks(self):
+        # Backlinks parsed from JSON are only turned into Backlink objects
+        # the first time they are accessed. The JSON is read once and only
+        # cleared after the list is stored, so a thread racing this one
+        # either builds the list too or sees the finished one.
+        backlinks_json = self._backlinks_json
+        if backlinks_json is not None:
+            backlinks = [Backlink._from_dict(b) for b in backlinks_json]
+            self._backlinks = backlinks
+            self._backlinks_json = None
+            return backlinks
+        return self._backlinks
+
+    @backlinks.setter
+    def backlinks(self, backlinks):
+        self._backlinks = backlinks
+        self._backlinks_json = None
+
     @staticmethod
     def _from_dict(match_json):
         """
@@ -145,23 +240,27 @@ class Match(object):
         if not isinstance(match_json, dict):
             raise TinEyeAPIError("500", ["Please pass in a dictionary to _from_dict()"])
 
-        backlinks = []
-        if "backlinks" in match_json:
-            for b in match_json["backlinks"]:
-                backlinks.append(Backlink._from_dict(b))
+        get = match_json.get
+
+        # Only a handful of image formats exist, share one string per format
+        # across all matches instead of keeping a copy per match
+        image_format = get("format")
+        if image_format:
+            image_format = sys.intern(image_format)
+
         match = Match(
-            image_url=match_json.get("image_url"),
-            domain=match_json.get("domain"),
-            score=match_json.get("score"),
-            width=match_json.get("width"),
-            height=match_json.get("height"),
-            size=match_json.get("size"),
-            format=match_json.get("format"),
-            filesize=match_json.get("filesize"),
-            overlay=match_json.get("overlay"),
-            tags=match_json.get("tags"),
-            backlinks=backlinks,
+            image_url=get("image_url"),
+            domain=get("domain"),
+            score=get("score"),
+            width=get("width"),
+            height=get("height"),
+            size=get("size"),
+            format=image_format,
+            filesize=get("filesize"),
+            overlay=get("overlay"),
+            tags=get("tags"),
         )
+        match._backlinks_json = get("backlinks") or ()
         return match
 
 
@@ -176,17 +275,17 @@ class Backlink(object):
     - `crawl_date`, the date the image was crawled.
     """
 
+    __slots__ = ("url", "backlink", "crawl_date")
+
     def __init__(self, url=None, backlink=None, crawl_date=None):
         self.url = url
         self.backlink = backlink
         self.crawl_date = crawl_date
 
     def __repr__(self):
-        return '%s(url="%s", backlink="%s", crawl_date=%s)' % (
-            self.__class__.__name__,
-            self.url,
-            self.backlink,
-            str(self.crawl_date),
+        return (
+            f'{self.__class__.__name__}(url="{self.url}", '
+            f'backlink="{self.backlink}", crawl_date={self.crawl_date})'
         )
 
     @staticmethod
@@ -203,14 +302,12 @@ class Backlink(object):
         if not isinstance(backlink_json, dict):
             raise TinEyeAPIError("500", ["Please pass in a dictionary to _from_dict()"])
 
-        crawl_date = datetime.min
-        if backlink_json.get("crawl_date"):
-            crawl_date = time.strptime(backlink_json.get("crawl_date"), "%Y-%m-%d")
-            crawl_date = datetime(*crawl_date[:6])
+        get = backlink_json.get
+        crawl_date = get("crawl_date")
         return Backlink(
-            url=backlink_json.get("url"),
-            backlink=backlink_json.get("backlink"),
-            crawl_date=crawl_date,
+            url=get("url"),
+            backlink=get("backlink"),
+            crawl_date=_parse_date(crawl_date) if crawl_date else datetime.min,
         )
 
 
@@ -231,6 +328,12 @@ class TinEyeAPIRequest(object):
         >>> api.search_url(url='http://tineye.com/images/meloncat.jpg')
         TinEyeResponse(...)
 
+    Searching for several image URLs in parallel:
+
+        >>> api.search_urls_bulk(['http://tineye.com/images/meloncat.jpg',
+        ...                       'http://tineye.com/images/tineye_logo_big.png'])
+        [TinEyeResponse(...), TinEyeResponse(...)]
+
     Searching for an image using image data:
 
         >>> fp = open('meloncat.jpg', 'rb')
@@ -255,33 +358,63 @@ class TinEyeAPIRequest(object):
         >>> api.image_count()
         22117595538
 
+    Responses to `image_count` are cached for a minute. Identical `search_url`
+    and `remaining_searches` calls can also be cached by passing
+    `search_cache_ttl` and `remaining_searches_cache_ttl`, the number of
+    seconds their results stay valid. Pass `cache_size=0` to disable caching
+    entirely.
+
     """
 
     def __init__(
-        self, api_url="https://api.tineye.com/rest/", public_key="", private_key=""
+        self,
+        api_url="https://api.tineye.com/rest/",
+        public_key="",
+        private_key="",
+        cache_size=128,
+        search_cache_ttl=0,
+        remaining_searches_cache_ttl=0,
     ):
-        self.http_pool = urllib3.PoolManager(
-            cert_reqs="CERT_REQUIRED",
-            ca_certs=certifi.where(),
-            timeout=urllib3.Timeout(connect=15.0, read=60.0),
-        )
+        self.http_pool = _http_pool
         self.request = APIRequest(api_url, public_key, private_key)
+        self.cache = ResponseCache(maxsize=cache_size)
+        self.search_cache_ttl = search_cache_ttl
+        self.remaining_searches_cache_ttl = remaining_searches_cache_ttl
 
-    def _request(self, method, params=None, image_file=None, **kwargs):
+    def _request(self, method, params=None, image_file=None, cache_ttl=0, **kwargs):
         """
         Send request to API and process results.
 
         - `method`, API method to call.
         - `params`, dictionary of fields to send to the API call.
         - `image_file`, tuple containing info (filename, data) about image to send.
+        - `cache_ttl`, number of seconds to cache the response for, 0 disables caching.
+          Image uploads are never cached.
 
         Returns: a JSON parsed object.
         """
 
-        # Pass in any extra keyword arguments as parameters to the API call
-        if not params:
+        # Pass in any extra keyword arguments as parameters to the API call,
+        # merging into a new dictionary so the caller's one is left untouched
+        if kwargs:
+            params = dict(params, **kwargs) if params else kwargs
+        elif params is None:
             params = {}
-        params.update(kwargs)
+
+        cache_key = None
+        if cache_ttl > 0 and image_file is None:
+            cache_key = (method, tuple(sorted(params.items())))
+            try:
+                body = self.cache.get(cache_key)
+            except TypeError:
+                # Parameter values that can't be hashed, such as lists, are
+                # still sent but the response isn't cached
+                cache_key = None
+            else:
+                # The raw body is cached and decoded again for every caller,
+                # so changes one caller makes to its result can't leak
+                if body is not None:
+                    return json_loads(body)
 
         try:
             obj = None
@@ -290,7 +423,9 @@ class TinEyeAPIRequest(object):
             # If an image file was provided, send a POST request, else send a GET request
             if image_file is None:
                 request_string = self.request.get_request(method, params)
-                response = self.http_pool.request("GET", request_string)
+                response = self.http_pool.request(
+                    "GET", request_string, preload_content=False
+                )
             else:
                 filename = image_file[0]
                 request_string, boundary = self.request.post_request(
@@ -301,16 +436,26 @@ class TinEyeAPIRequest(object):
                     request_string,
                     fields={"image_upload": image_file},
                     multipart_boundary=boundary,
+                    preload_content=False,
                 )
-            # Parse the JSON into a Python object
-            obj = json.loads(response.data.decode("utf-8"))
+            # Parse the JSON into a Python object, the body is read directly
+            # from the socket and the connection goes straight back to the pool
+            try:
+                body = response.read()
+            finally:
+                response.release_conn()
+            obj = json_loads(body)
 
         except ValueError as e:
             raise TinEyeAPIError("500", ["Could not decode JSON: %s" % e])
 
         # Check the result of the API call
-        if response.status != http.client.OK or obj.get("code") != http.client.OK:
-            raise TinEyeAPIError(obj["code"], obj.get("messages"))
+        code = obj.get("code")
+        if response.status != _HTTP_OK or code != _HTTP_OK:
+            raise TinEyeAPIError(code, obj.get("messages"))
+
+        if cache_key is not None:
+            self.cache.set(cache_key, body, cache_ttl)
 
         return obj
 
@@ -339,10 +484,30 @@ class TinEyeAPIRequest(object):
             "order": order,
         }
 
-        obj = self._request("search", params, **kwargs)
+        obj = self._request("search", params, cache_ttl=self.search_cache_ttl, **kwargs)
 
         return TinEyeResponse._from_dict(obj)
 
+    def search_urls_bulk(self, urls, max_workers=16, **kwargs):
+        """
+        Perform several image URL searches in parallel.
+
+        The requests share the same connection pool, so concurrent searches
+        reuse its keep-alive connections to the API server.
+
+        - `urls`, a list of image URLs to search for.
+        - `max_workers`, maximum number of searches running at once, defaults to 16.
+        - `kwargs`, extra arguments passed to `search_url` for every search.
+
+        Returns: a list of TinEye Response objects, in the same order as `urls`.
+        """
+
+        def search(url):
+            return self.search_url(url, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(search, urls))
+
     def search_data(
         self, data, offset=0, limit=100, sort="score", order="desc", **kwargs
     ):
@@ -376,26 +541,20 @@ class TinEyeAPIRequest(object):
         Returns: a dictionary with remaining searches, start time and end time of block.
         """
 
-        bundle_list = []
-
-        obj = self._request("remaining_searches", **kwargs)
+        obj = self._request(
+            "remaining_searches", cache_ttl=self.remaining_searches_cache_ttl, **kwargs
+        )
 
         results = obj.get("results")
 
-        for bundle in results.get("bundles"):
-
-            start_date = time.strptime(bundle.get("start_date"), "%Y-%m-%d %X UTC")
-            start_date = datetime(*start_date[:6])
-            expire_date = time.strptime(bundle.get("expire_date"), "%Y-%m-%d %X UTC")
-            expire_date = datetime(*expire_date[:6])
-
-            bundle_list.append(
-                {
-                    "remaining_searches": bundle.get("remaining_searches"),
-                    "start_date": start_date,
-                    "expire_date": expire_date,
-                }
-            )
+        bundle_list = [
+            {
+                "remaining_searches": bundle.get("remaining_searches"),
+                "start_date": _parse_utc_datetime(bundle.get("start_date")),
+                "expire_date": _parse_utc_datetime(bundle.get("expire_date")),
+            }
+            for bundle in results.get("bundles")
+        ]
 
         return {
             "bundles": bundle_list,
@@ -411,5 +570,5 @@ class TinEyeAPIRequest(object):
         Returns: TinEye image count.
         """
 
-        obj = self._request("image_count", **kwargs)
+        obj = self._request("image_count", cache_ttl=IMAGE_COUNT_CACHE_TTL, **kwargs)
         return obj.get("results")
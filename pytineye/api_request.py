@@ -9,48 +9,124 @@ For more information see https://services.tineye.com/developers/tineyeapi/authen
 Copyright (c) 2021 TinEye. All rights reserved worldwide.
 """
 
-from hashlib import sha256 as sha
+from functools import lru_cache
 import hmac
-import sys
+from operator import itemgetter
+import os
+import secrets
+import string
 import time
 import urllib.parse
 
-from Crypto.Random import random
-from future.standard_library import install_aliases
-
 from .exceptions import APIRequestError
 
-install_aliases()
+# Start of the content type of an image upload, followed by its boundary
+_MULTIPART_CONTENT_TYPE = b"multipart/form-data; boundary="
+
+
+@lru_cache(maxsize=32)
+def _quote_filename(filename):
+    """
+    URL encode and lowercase an uploaded image filename for signing.
+    Uploads nearly always reuse the same filename, so results are cached.
+
+    - `filename`, the filename of the image being uploaded.
+
+    Returns: the encoded filename as bytes.
+    """
+
+    return urllib.parse.quote_plus(filename).lower().encode()
+
+
+@lru_cache(maxsize=128)
+def _quote_image_url(image_url):
+    """
+    URL encode an image URL search parameter. Searches for the same image
+    URL are often repeated or retried, so results are cached.
+
+    - `image_url`, the image URL, as a string or UTF-8 encoded bytes.
+
+    Returns: the encoded image URL.
+    """
+
+    if isinstance(image_url, bytes):
+        image_url = image_url.decode("utf-8")
+    return urllib.parse.quote_plus(image_url, "~")
 
 
 class APIRequest(object):
     """ Class providing authentication with the TinEye API server. """
 
+    __slots__ = (
+        "_api_url",
+        "public_key",
+        "_private_key",
+        "_hmac",
+        "_get_hmac",
+        "_post_hmac",
+        "_method_urls",
+    )
+
+    # Parameters added by the signing process, never part of the sorted parameters
+    special_params = frozenset(
+        ("api_key", "public_key", "api_sig", "date", "nonce", "image_upload")
+    )
+
     # Nonce length
     min_nonce_length = 24
     max_nonce_length = 255
-    nonce_allowable_chars = (
-        "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRTSUVWXYZ0123456789-_=.,*^"
-    )
+    nonce_allowable_chars = string.ascii_letters + string.digits + "-_=.,*^"
+    # Table mapping every byte value onto the nonce alphabet, and the byte
+    # values above the largest multiple of the alphabet size that fits in a
+    # byte. Those are discarded so every character is equally likely.
+    _nonce_table = (nonce_allowable_chars * (256 // len(nonce_allowable_chars) + 1))[
+        :256
+    ].encode("ascii")
+    _nonce_rejected = bytes(range(256 - 256 % len(nonce_allowable_chars), 256))
 
     def __init__(self, api_url, public_key, private_key):
         self.api_url = api_url
         self.public_key = public_key
         self.private_key = private_key
 
+    @property
+    def api_url(self):
+        return self._api_url
+
+    @api_url.setter
+    def api_url(self, api_url):
+        self._api_url = api_url
+        # Cache of method name to method URL, as a string and UTF-8 encoded,
+        # emptied whenever the URL changes
+        self._method_urls = {}
+
+    @property
+    def private_key(self):
+        return self._private_key
+
+    @private_key.setter
+    def private_key(self, private_key):
+        self._private_key = private_key
+        # HMAC keyed with the private key, copied for every signature so the
+        # key padding is only computed once. Rebuilt whenever the key changes.
+        # Naming the digest lets hmac use OpenSSL's HMAC implementation directly.
+        private_key_bytes = private_key.encode("utf-8")
+        self._hmac = hmac.new(private_key_bytes, digestmod="sha256")
+        # Keyed HMACs already fed the constant private key and HTTP verb that
+        # start the GET and POST strings to sign
+        self._get_hmac = self._hmac.copy()
+        self._get_hmac.update(private_key_bytes + b"GET")
+        self._post_hmac = self._hmac.copy()
+        self._post_hmac.update(private_key_bytes + b"POST")
+
     @staticmethod
     def _generate_boundary():
         """
         Generate a boundary string for a multipart request.
-        Adapted from Python's email.generator._make_boundary() method.
 
         Returns: a boundary string.
         """
-        width = len(repr(sys.maxsize - 1))
-        fmt = "%%0%dd" % width
-        token = random.randrange(sys.maxsize)
-        boundary = ("-" * 15) + (fmt % token) + "--"
-        return boundary
+        return "---------------%s--" % secrets.token_hex(16)
 
     @staticmethod
     def _generate_nonce(nonce_length=24):
@@ -61,56 +137,57 @@ class APIRequest(object):
 
         Returns: a nonce.
         """
-        try:
-            int(nonce_length)
-            if (
-                nonce_length < APIRequest.min_nonce_length
-                or nonce_length > APIRequest.max_nonce_length
-            ):
-                raise ValueError()
-        except ValueError:
+        if (
+            not isinstance(nonce_length, int)
+            or nonce_length < APIRequest.min_nonce_length
+            or nonce_length > APIRequest.max_nonce_length
+        ):
             raise APIRequestError(
                 "Nonce length must be an int between %d and %d chars"
                 % (APIRequest.min_nonce_length, APIRequest.max_nonce_length)
             )
 
-        rand = random.StrongRandom()
-
-        nonce = ""
-        nonce = [
-            rand.choice(APIRequest.nonce_allowable_chars)
-            for _ in range(0, nonce_length)
-        ]
+        # Map random bytes onto the alphabet in a single C level pass,
+        # oversampling so one read from the OS is almost always enough
+        nonce = b""
+        while len(nonce) < nonce_length:
+            nonce += os.urandom(nonce_length * 2).translate(
+                APIRequest._nonce_table, APIRequest._nonce_rejected
+            )
 
-        return "".join(nonce)
+        return nonce[:nonce_length].decode("ascii")
 
-    def _generate_get_hmac_signature(self, method, nonce, date, request_params=None):
+    def _generate_get_hmac_signature(
+        self, method, nonce, date, request_params=None, params=None
+    ):
         """
         Generate the HMAC signature hash for a GET request.
 
         - `method`, the API method being called.
         - `nonce`, a nonce.
-        - `date`, UNIX timestamp of the request.
+        - `date`, UNIX timestamp of the request, as an int or a string.
         - `request_params`, dictionary of other search parameters.
+        - `params`, parameters already returned by `_collect_params`,
+          used instead of `request_params`.
 
         Returns: an HMAC signature hash.
         """
 
-        if request_params is None:
-            request_params = {}
-
-        http_verb = "GET"
-
-        param_str = self._sort_params(request_params=request_params)
-        request_url = "%s%s/" % (self.api_url, method)
-        to_sign = (
-            self.private_key + http_verb + str(date) + nonce + request_url + param_str
+        if params is None:
+            params = self._collect_params(request_params)
+
+        param_str = self._join_params(params)
+        request_url = self._method_url(method)[1]
+        return self._sign(
+            self._get_hmac,
+            str(date).encode(),
+            nonce.encode(),
+            request_url,
+            param_str.encode("utf-8"),
         )
 
-        return self._generate_hmac_signature(to_sign)
-
     def _generate_post_hmac_signature(
-        self, method, boundary, nonce, date, filename, request_params=None
+        self, method, boundary, nonce, date, filename, request_params=None, params=None
     ):
         """
         Generate the HMAC signature hash for a POST request.
@@ -118,33 +195,45 @@ class APIRequest(object):
         - `method`, the API method being called.
         - `boundary`, the HTTP request's boundary string.
         - `nonce`, a nonce.
-        - `date`, UNIX timestamp of the request.
+        - `date`, UNIX timestamp of the request, as an int or a string.
         - `filename`, filename of the image being uploaded.
         - `request_params`, dictionary of other search parameters.
+        - `params`, parameters already returned by `_collect_params`,
+          used instead of `request_params`.
 
         Returns: an HMAC signature hash.
         """
 
-        if request_params is None:
-            request_params = {}
-
-        http_verb = "POST"
-        content_type = "multipart/form-data; boundary=%s" % boundary
-
-        param_str = self._sort_params(request_params=request_params)
-        request_url = "%s%s/" % (self.api_url, method)
-        to_sign = (
-            self.private_key
-            + http_verb
-            + content_type
-            + urllib.parse.quote_plus(filename).lower()
-            + str(date)
-            + nonce
-            + request_url
-            + param_str
+        if params is None:
+            params = self._collect_params(request_params)
+
+        param_str = self._join_params(params)
+        request_url = self._method_url(method)[1]
+        return self._sign(
+            self._post_hmac,
+            _MULTIPART_CONTENT_TYPE,
+            boundary.encode(),
+            _quote_filename(filename),
+            str(date).encode(),
+            nonce.encode(),
+            request_url,
+            param_str.encode("utf-8"),
         )
 
-        return self._generate_hmac_signature(to_sign)
+    def _method_url(self, method):
+        """
+        Helper method to get the URL of an API method, built once per method.
+
+        - `method`, API method being called.
+
+        Returns: a tuple of the API method URL and its UTF-8 encoded bytes.
+        """
+
+        urls = self._method_urls.get(method)
+        if urls is None:
+            url = "%s%s/" % (self.api_url, method)
+            urls = self._method_urls[method] = (url, url.encode("utf-8"))
+        return urls
 
     def _generate_hmac_signature(self, to_sign):
         """
@@ -155,13 +244,82 @@ class APIRequest(object):
         Returns: HMAC signature hash.
         """
 
-        signature = ""
-        signature = hmac.new(
-            self.private_key.encode("utf-8"), to_sign.encode("utf-8"), sha
-        )
+        signature = self._hmac.copy()
+        signature.update(to_sign.encode("utf-8"))
+
+        return signature.hexdigest()
+
+    def _sign(self, prefix_hmac, *parts):
+        """
+        Generate the HMAC signature hash of a message given in parts.
+
+        The parts are fed to the HMAC one after the other, which gives the
+        same signature as their concatenation without building it.
+
+        - `prefix_hmac`, keyed HMAC already fed the start of the message.
+        - `parts`, the remaining UTF-8 encoded parts of the message to sign.
+
+        Returns: HMAC signature hash.
+        """
+
+        signature = prefix_hmac.copy()
+        for part in parts:
+            signature.update(part)
 
         return signature.hexdigest()
 
+    def _collect_params(self, request_params):
+        """
+        Helper method to collect the request parameters to send, sorted by name.
+        Parameter names are lowercased and the image_url parameter is URL encoded.
+
+        The result is shared by the signature and the request URL, so the
+        parameters are only sorted and encoded once per request.
+
+        - `request_params`, dictionary of extra search parameters, or None.
+
+        Returns: a list of (name, value) tuples in alphabetical order.
+        """
+
+        # Most methods other than searches send no extra parameters
+        if not request_params:
+            return []
+
+        params = []
+
+        for param, value in request_params.items():
+            if param is None:
+                continue
+            param = param.lower()
+            if param in APIRequest.special_params:
+                continue
+            # Assume URL with % was already urlencoded
+            if param == "image_url":
+                value = _quote_image_url(value)
+            params.append((param, value))
+
+        params.sort(key=itemgetter(0))
+
+        return params
+
+    @staticmethod
+    def _join_params(params, lowercase=True):
+        """
+        Helper method to join collected request parameters into a query string.
+
+        - `params`, a list of (name, value) tuples returned by `_collect_params`.
+        - `lowercase`, whether to lowercase the encoded image_url, as is done
+          for the string to sign.
+
+        Returns: the parameters as query string params.
+        """
+
+        return "&".join(
+            "%s=%s"
+            % (param, value.lower() if lowercase and param == "image_url" else value)
+            for param, value in params
+        )
+
     def _sort_params(self, request_params, lowercase=True):
         """
         Helper method to sort request parameters.
@@ -174,78 +332,45 @@ class APIRequest(object):
             string params.
         """
 
-        query_params = {}
-        params = []
+        if not request_params:
+            return ""
 
-        for param in request_params.keys():
-            if param is None:
-                continue
-            if param.lower() not in [
-                "api_key",
-                "public_key",
-                "api_sig",
-                "date",
-                "nonce",
-                "image_upload",
-            ]:
-                # Assume URL with % was already urlencoded
-                if param.lower() == "image_url":
-                    value = request_params[param]
-                    if isinstance(value, bytes):
-                        value = value.decode("utf-8")
-                    # Lowercase and encode the URL if needed
-                    url_escape = urllib.parse.quote_plus(value, "~")
-                    query_params[param.lower()] = url_escape
-                    if lowercase:
-                        query_params[param.lower()] = url_escape.lower()
-                else:
-                    query_params[param.lower()] = request_params[param]
-                params.append(param.lower())
-
-        params.sort()
-        query_param_pairs = []
-        for param in params:
-            query_param_pairs.append("%s=%s" % (param, query_params[param]))
-
-        return "&".join(query_param_pairs)
-
-    def _request_url(self, method, nonce, date, api_signature, request_params):
+        return self._join_params(self._collect_params(request_params), lowercase)
+
+    def _request_url(
+        self, method, nonce, date, api_signature, request_params=None, params=None
+    ):
         """
         Helper method to generate a URL to call given a method,
         a signature and parameters.
 
         - `method`, API method being called.
         - `nonce`, a nonce.
-        - `date`, UNIX timestamp of the request.
+        - `date`, UNIX timestamp of the request, as an int or a string.
         - `api_signature`, the signature to be included with the URL.
         - `request_params`, the parameters to be included with the URL.
+        - `params`, parameters already returned by `_collect_params`,
+          used instead of `request_params`.
 
         Returns: The API URL to send a request to.
         """
 
-        base_url = "%s%s/" % (self.api_url, method)
-
-        if self.public_key != "":
-            request_url = "%s?api_key=%s&date=%s&nonce=%s&api_sig=%s"
-
-            request_url = request_url % (
-                base_url,
-                self.public_key,
-                str(date),
-                nonce,
-                api_signature,
-            )
-        else:
-            request_url = "%s?" % base_url
+        base_url = self._method_url(method)[0]
 
         # Need to sort all other parameters
-        extra_params = self._sort_params(request_params=request_params, lowercase=False)
+        if params is None:
+            params = self._collect_params(request_params)
+        extra_params = self._join_params(params, lowercase=False)
 
-        if extra_params != "" and self.public_key != "":
-            request_url += "&" + extra_params
-        else:
-            request_url += extra_params
+        if not self.public_key:
+            return f"{base_url}?{extra_params}"
 
+        request_url = (
+            f"{base_url}?api_key={self.public_key}&date={date}"
+            f"&nonce={nonce}&api_sig={api_signature}"
+        )
+        if extra_params:
+            return f"{request_url}&{extra_params}"
         return request_url
 
     def get_request(self, method, request_params=None):
@@ -258,18 +383,17 @@ class APIRequest(object):
         Returns: a URL to send the search request to including the search parameters.
         """
 
-        if request_params is None:
-            request_params = {}
-
         # Have to generate a nonce and date to use in generating a GET request signature
+        # The date is formatted once and shared by the signature and the URL
         nonce = APIRequest._generate_nonce()
-        date = int(time.time())
+        date = str(int(time.time()))
 
+        params = self._collect_params(request_params)
         api_signature = self._generate_get_hmac_signature(
-            method, nonce, date, request_params=request_params
+            method, nonce, date, params=params
         )
 
-        return self._request_url(method, nonce, date, api_signature, request_params)
+        return self._request_url(method, nonce, date, api_signature, params=params)
 
     def post_request(self, method, filename, request_params=None):
         """
@@ -288,9 +412,6 @@ class APIRequest(object):
         - `boundary`, the boundary to be used in the POST request.
         """
 
-        if request_params is None:
-            request_params = {}
-
         if filename is None or not len(str(filename).strip()):
             raise APIRequestError("Must specify an image to search for.")
 
@@ -298,13 +419,14 @@ class APIRequest(object):
         # request signature
         boundary = APIRequest._generate_boundary()
         nonce = self._generate_nonce()
-        date = int(time.time())
+        date = str(int(time.time()))
 
+        params = self._collect_params(request_params)
         api_signature = self._generate_post_hmac_signature(
-            "search", boundary, nonce, date, filename, request_params=request_params
+            "search", boundary, nonce, date, filename, params=params
         )
 
         return (
-            self._request_url(method, nonce, date, api_signature, request_params),
+            self._request_url(method, nonce, date, api_signature, params=params),
             boundary,
         )
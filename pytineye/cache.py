@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+cache.py
+
+Small in-memory cache for TinEye API responses.
+
+Copyright (c) 2021 TinEye. All rights reserved worldwide.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class ResponseCache(object):
+    """
+    Thread-safe LRU cache where every entry expires after its own TTL.
+
+    - `maxsize`, maximum number of entries kept, the least recently used
+      entry is evicted first.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up a cached value.
+
+        - `key`, the cache key.
+
+        Returns: the cached value, or None if missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expiry = entry
+            if expiry <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """
+        Store a value in the cache.
+
+        - `key`, the cache key.
+        - `value`, the value to store.
+        - `ttl`, number of seconds the value stays valid.
+        """
+
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove every entry from the cache. """
+
+        with self._lock:
+            self._entries.clear()
@@ -9,9 +9,8 @@ setup(
     description="Python client for the TinEye API.",
     classifiers=[
         "Intended Audience :: Developers",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
     ],
     keywords=["tineye", "api", "reverse image search"],
     author="TinEye",
@@ -21,10 +20,10 @@ setup(
     packages=find_packages(exclude=["ez_setup", "examples", "tests"]),
     include_package_data=True,
     zip_safe=False,
+    python_requires=">=3.7",
     tests_require=["nose"],
     install_requires=[
-        "future==0.18.2",
-        "pycryptodome==3.10.1",
         "urllib3[secure]==1.26.4",
     ],
+    extras_require={"orjson": ["orjson"]},
 )
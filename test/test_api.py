@@ -9,55 +9,130 @@ Copyright (c) 2021 TinEye. All rights reserved worldwide.
 """
 
 from datetime import datetime
+import json
+import os
 import unittest
+from unittest import mock
+import urllib.parse
 
 from pytineye.api import Backlink, Match, TinEyeResponse
-from pytineye.api import TinEyeAPIRequest
+from pytineye.api import TinEyeAPIRequest, _http_pool
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Canned API responses, keyed by API method
+FIXTURES = {}
+for method in ("search", "remaining_searches", "image_count"):
+    with open(os.path.join(FIXTURES_DIR, "%s.json" % method)) as fp:
+        FIXTURES[method] = json.load(fp)
+
+
+def fixture_response(http_method, url, *args, **kwargs):
+    """
+    Mock urllib3 request returning the canned response of the API method
+    in `url`, honouring the limit parameter of searches.
+    """
+
+    url = urllib.parse.urlsplit(url)
+    body = dict(FIXTURES[url.path.rstrip("/").rsplit("/", 1)[-1]])
+    limit = urllib.parse.parse_qs(url.query).get("limit")
+    if limit:
+        matches = body["results"]["matches"][: int(limit[0])]
+        body["results"] = dict(body["results"], matches=matches)
+    return mock_response(json.dumps(body).encode())
+
+
+def mock_response(body, status=200):
+    """ Build a mock urllib3 response returning `body`. """
+
+    response = mock.Mock(status=status)
+    response.read.return_value = body
+    return response
 
 
 class TestTinEyeAPIRequest(unittest.TestCase):
     """ Test TinEyeAPIRequest class. """
 
-    def setUp(self):
-        self.api = TinEyeAPIRequest(
+    @classmethod
+    def setUpClass(cls):
+        cls.api = TinEyeAPIRequest(
             api_url="https://api.tineye.com/rest/",
             public_key="LCkn,2K7osVwkX95K4Oy",
             private_key="6mm60lsCNIB,FwOWjJqA80QZHh9BMwc-ber4u=t^",
         )
+        with open("test/images/meloncat.jpg", "rb") as fp:
+            cls.image_bytes = fp.read()
 
-    def tearDown(self):
-        pass
+    def setUp(self):
+        # The API object is shared, so start every test with an empty cache
+        self.api.cache.clear()
+
+    def mock_http_pool(self):
+        """ Replace the shared API object's connection pool for one test. """
+
+        patcher = mock.patch.object(self.api, "http_pool")
+        self.addCleanup(patcher.stop)
+        return patcher.start()
 
     def test_backlink(self):
         """ Test TinEyeAPI.Backlink object. """
 
-        backlink = {"url": "url", "crawl_date": "2010-02-19", "backlink": "backlink"}
-        b = Backlink._from_dict(backlink)
+        b = Backlink._from_dict(
+            {"url": "url", "crawl_date": "2010-02-19", "backlink": "backlink"}
+        )
         self.assertEqual(
             repr(b),
             'Backlink(url="url", backlink="backlink", crawl_date=2010-02-19 00:00:00)',
         )
-        self.assertEqual(b.url, "url")
+
+        # Backlink JSON, followed by the expected url, crawl_date and backlink
+        cases = [
+            (
+                {"url": "url", "crawl_date": "2010-02-19", "backlink": "backlink"},
+                "url",
+                datetime(2010, 2, 19, 0, 0),
+                "backlink",
+            ),
+            (
+                {"url": "url", "crawl_date": "", "backlink": "backlink"},
+                "url",
+                datetime(1, 1, 1, 0, 0),
+                "backlink",
+            ),
+            (
+                {"url": "", "crawl_date": "", "backlink": ""},
+                "",
+                datetime(1, 1, 1, 0, 0),
+                "",
+            ),
+            (
+                {"url": None, "crawl_date": None, "backlink": None},
+                None,
+                datetime(1, 1, 1, 0, 0),
+                None,
+            ),
+        ]
+        for backlink, url, crawl_date, backlink_url in cases:
+            with self.subTest(backlink=backlink):
+                b = Backlink._from_dict(backlink)
+                self.assertEqual(b.url, url)
+                self.assertEqual(b.crawl_date, crawl_date)
+                self.assertEqual(b.backlink, backlink_url)
+
+    def test_backlink_crawl_date(self):
+        """ Test Backlink.crawl_date parsing and overriding. """
+
+        b = Backlink._from_dict({"url": "url", "crawl_date": "2010-02-19"})
         self.assertEqual(b.crawl_date, datetime(2010, 2, 19, 0, 0))
-        self.assertEqual(b.backlink, "backlink")
-
-        backlink = {"url": "url", "crawl_date": "", "backlink": "backlink"}
-        b = Backlink._from_dict(backlink)
-        self.assertEqual(b.url, "url")
-        self.assertEqual(b.crawl_date, datetime(1, 1, 1, 0, 0))
-        self.assertEqual(b.backlink, "backlink")
-
-        backlink = {"url": "", "crawl_date": "", "backlink": ""}
-        b = Backlink._from_dict(backlink)
-        self.assertEqual(b.url, "")
-        self.assertEqual(b.crawl_date, datetime(1, 1, 1, 0, 0))
-        self.assertEqual(b.backlink, "")
-
-        backlink = {"url": None, "crawl_date": None, "backlink": None}
-        b = Backlink._from_dict(backlink)
-        self.assertEqual(b.url, None)
-        self.assertEqual(b.crawl_date, datetime(1, 1, 1, 0, 0))
-        self.assertEqual(b.backlink, None)
+
+        b = Backlink._from_dict({"url": "url"})
+        self.assertEqual(b.crawl_date, datetime.min)
+
+        b.crawl_date = datetime(2011, 1, 1)
+        self.assertEqual(b.crawl_date, datetime(2011, 1, 1))
+
+        with self.assertRaises(ValueError):
+            Backlink._from_dict({"url": "url", "crawl_date": "19/02/2010"})
 
     def test_match(self):
         """ Test TinEyeAPI.Match object. """
@@ -82,70 +157,94 @@ class TestTinEyeAPIRequest(unittest.TestCase):
         self.assertEqual(
             repr(m), 'Match(image_url="image_url", score=14.80, width=350, height=297)'
         )
-        self.assertEqual(len(m.backlinks), 1)
-        self.assertEqual(m.domain, "domain")
-        self.assertEqual(m.score, 14.8)
-        self.assertEqual(m.format, "JPEG")
-        self.assertEqual(m.overlay, "overlay")
-        self.assertEqual(m.height, 297)
-        self.assertEqual(m.width, 350)
-        self.assertEqual(m.image_url, "image_url")
-        self.assertEqual(m.filesize, 87918)
-        self.assertEqual(m.tags, [])
-        self.assertEqual(m.size, 103950)
-
-        match = {
-            "backlinks": [
-                {"url": "url", "crawl_date": "2008-04-27", "backlink": "backlink"},
-                {"url": "url", "crawl_date": "2009-04-27", "backlink": "backlink"},
-            ],
-            "domain": "domain",
-            "score": 67.19,
-            "format": "JPEG",
-            "overlay": "overlay",
-            "height": 297,
-            "width": 350,
-            "image_url": "image_url",
-            "filesize": 87918,
-            "contributor": True,
-            "size": 103950,
-        }
-        m = Match._from_dict(match)
-        self.assertEqual(len(m.backlinks), 2)
-        self.assertEqual(m.domain, "domain")
-        self.assertEqual(m.score, 67.19)
-        self.assertEqual(m.format, "JPEG")
-        self.assertEqual(m.overlay, "overlay")
-        self.assertEqual(m.height, 297)
-        self.assertEqual(m.width, 350)
-        self.assertEqual(m.image_url, "image_url")
-        self.assertEqual(m.filesize, 87918)
-        self.assertEqual(m.tags, [])
-        self.assertEqual(m.size, 103950)
+        m.width, m.height = 350.0, 297.0
+        self.assertEqual(
+            repr(m), 'Match(image_url="image_url", score=14.80, width=350, height=297)'
+        )
 
-        match = {
-            "backlinks": [],
-            "domain": "",
-            "score": 0,
-            "format": "",
-            "overlay": "",
-            "image_url": "image_url",
-            "filesize": 87918,
-            "contributor": True,
-            "size": 103950,
-        }
-        m = Match._from_dict(match)
-        self.assertEqual(len(m.backlinks), 0)
-        self.assertEqual(m.domain, "")
-        self.assertEqual(m.score, 0)
-        self.assertEqual(m.format, "")
-        self.assertEqual(m.overlay, "")
-        self.assertEqual(m.height, None)
-        self.assertEqual(m.width, None)
-        self.assertEqual(m.image_url, "image_url")
-        self.assertEqual(m.filesize, 87918)
-        self.assertEqual(m.tags, [])
-        self.assertEqual(m.size, 103950)
+        # Match JSON, followed by the expected attributes of the Match
+        cases = [
+            (
+                match,
+                {
+                    "domain": "domain",
+                    "score": 14.8,
+                    "format": "JPEG",
+                    "overlay": "overlay",
+                    "height": 297,
+                    "width": 350,
+                },
+            ),
+            (
+                {
+                    "backlinks": [
+                        {
+                            "url": "url",
+                            "crawl_date": "2008-04-27",
+                            "backlink": "backlink",
+                        },
+                        {
+                            "url": "url",
+                            "crawl_date": "2009-04-27",
+                            "backlink": "backlink",
+                        },
+                    ],
+                    "domain": "domain",
+                    "score": 67.19,
+                    "format": "JPEG",
+                    "overlay": "overlay",
+                    "height": 297,
+                    "width": 350,
+                    "image_url": "image_url",
+                    "filesize": 87918,
+                    "contributor": True,
+                    "size": 103950,
+                },
+                {
+                    "domain": "domain",
+                    "score": 67.19,
+                    "format": "JPEG",
+                    "overlay": "overlay",
+                    "height": 297,
+                    "width": 350,
+                },
+            ),
+            (
+                {
+                    "backlinks": [],
+                    "domain": "",
+                    "score": 0,
+                    "format": "",
+                    "overlay": "",
+                    "image_url": "image_url",
+                    "filesize": 87918,
+                    "contributor": True,
+                    "size": 103950,
+                },
+                {
+                    "domain": "",
+                    "score": 0,
+                    "format": "",
+                    "overlay": "",
+                    "height": None,
+                    "width": None,
+                },
+            ),
+        ]
+        for match, expected in cases:
+            with self.subTest(score=match["score"]):
+                m = Match._from_dict(match)
+                self.assertEqual(len(m.backlinks), len(match["backlinks"]))
+                expected = dict(
+                    expected,
+                    image_url="image_url",
+                    filesize=87918,
+                    tags=[],
+                    size=103950,
+                )
+                for field, value in expected.items():
+                    with self.subTest(field=field):
+                        self.assertEqual(getattr(m, field), value)
 
     def test_tineye_response(self):
         """ Test TinEyeAPI.TinEyeResponse object. """
@@ -173,10 +272,10 @@ class TestTinEyeAPIRequest(unittest.TestCase):
         self.assertEqual(
             repr(r),
             'TinEyeResponse(matches=[Match(image_url="", score=89.36, width=350, height=297)], stats={})',
-        ),
-        self.assertEqual(len(r.matches), 1)
-        self.assertEqual(r.matches[0].height, 297)
-        self.assertEqual(r.matches[0].width, 350)
+        )
+
+        # Response JSON, followed by the expected (height, width) of every match
+        cases = [(matches, [(297, 350)])]
 
         matches = {
             "results": {
@@ -210,19 +309,22 @@ class TestTinEyeAPIRequest(unittest.TestCase):
                 ]
             }
         }
-        r = TinEyeResponse._from_dict(matches)
-        self.assertEqual(len(r.matches), 2)
-        self.assertEqual(r.matches[1].height, 200)
-        self.assertEqual(r.matches[1].width, 300)
+        cases.append((matches, [(297, 350), (200, 300)]))
+        cases.append(({"results": {"matches": []}}, []))
 
-        matches = {"results": {"matches": []}}
-        r = TinEyeResponse._from_dict(matches)
-        self.assertEqual(len(r.matches), 0)
+        for matches, sizes in cases:
+            with self.subTest(matches=len(sizes)):
+                r = TinEyeResponse._from_dict(matches)
+                self.assertEqual([(m.height, m.width) for m in r.matches], sizes)
 
     def test_calls(self):
-        """ Test methods with API sandbox. """
+        """ Test methods against canned API responses. """
+
+        self.mock_http_pool()
+        self.api.http_pool.request.side_effect = fixture_response
+        self.api.http_pool.request_encode_body.side_effect = fixture_response
 
-        # Test search_url with sandbox
+        # Test search_url
         response = self.api.search_url(b"https://tineye.com/images/meloncat.jpg")
         self.assertEqual(len(response.matches), 100)
         self.assertTrue(response.stats["total_results"] > 1000)
@@ -233,11 +335,8 @@ class TestTinEyeAPIRequest(unittest.TestCase):
         self.assertEqual(len(response.matches), 10)
         self.assertTrue(response.stats["total_results"] > 1000)
 
-        # Test search_data with sandbox
-        filename = "test/images/meloncat.jpg"
-        data = ""
-        with open(filename, "rb") as fp:
-            data = fp.read()
+        # Test search_data
+        data = self.image_bytes
         response = self.api.search_data(data)
         self.assertEqual(len(response.matches), 100)
         self.assertTrue(response.stats["total_results"] > 1000)
@@ -245,11 +344,14 @@ class TestTinEyeAPIRequest(unittest.TestCase):
         response = self.api.search_data(data, limit=10)
         self.assertEqual(len(response.matches), 10)
         self.assertTrue(response.stats["total_results"] > 1000)
+        self.assertEqual(self.api.http_pool.request_encode_body.call_count, 2)
+        fields = self.api.http_pool.request_encode_body.call_args[1]["fields"]
+        self.assertEqual(fields["image_upload"][1], data)
 
-        # Test remaining_searches with sandbox
+        # Test remaining_searches
         remaining_searches = self.api.remaining_searches()
         self.assertEqual(remaining_searches["total_remaining_searches"], 5000)
-        self.assertTrue(remaining_searches["bundles"][0]["remaining_searches"], 5000)
+        self.assertEqual(remaining_searches["bundles"][0]["remaining_searches"], 5000)
         self.assertTrue("start_date" in remaining_searches["bundles"][0])
         self.assertTrue("expire_date" in remaining_searches["bundles"][0])
         self.assertTrue(
@@ -259,7 +361,7 @@ class TestTinEyeAPIRequest(unittest.TestCase):
             isinstance(remaining_searches["bundles"][0]["expire_date"], datetime)
         )
 
-        # Test image_count with sandbox
+        # Test image_count
         image_count = self.api.image_count()
         self.assertTrue(image_count > 10000000000)
 
@@ -269,3 +371,101 @@ class TestTinEyeAPIRequest(unittest.TestCase):
         response = {"results": {"matches": []}, "stats": {"total_results": 123}}
         r = TinEyeResponse._from_dict(response)
         self.assertEqual(r.stats["total_results"], 123)
+
+    def test_http_pool_retries(self):
+        """ Test that only connection errors are retried by the pool. """
+
+        retries = _http_pool.connection_pool_kw["retries"]
+        self.assertEqual(retries.total, 3)
+        self.assertEqual(retries.connect, 3)
+        self.assertEqual(retries.read, 0)
+        self.assertEqual(retries.status, 0)
+        self.assertEqual(retries.other, 0)
+        self.assertFalse(retries.status_forcelist)
+
+    def test_response_cache(self):
+        """ Test that idempotent API methods are served from the cache. """
+
+        response = mock_response(b'{"code": 200, "results": 12345}')
+        self.mock_http_pool()
+        self.api.http_pool.request.return_value = response
+
+        self.assertEqual(self.api.image_count(), 12345)
+        self.assertEqual(self.api.image_count(), 12345)
+        self.assertEqual(self.api.http_pool.request.call_count, 1)
+        self.assertEqual(response.release_conn.call_count, 1)
+
+        # Searches are only cached when a TTL is given
+        response.read.return_value = b'{"code": 200, "results": {"matches": []}}'
+        self.api.search_url("https://tineye.com/images/meloncat.jpg")
+        self.api.search_url("https://tineye.com/images/meloncat.jpg")
+        self.assertEqual(self.api.http_pool.request.call_count, 3)
+
+        self.api.search_cache_ttl = 60
+        self.addCleanup(setattr, self.api, "search_cache_ttl", 0)
+        self.api.search_url("https://tineye.com/images/meloncat.jpg")
+        self.api.search_url("https://tineye.com/images/meloncat.jpg")
+        self.assertEqual(self.api.http_pool.request.call_count, 4)
+
+        # Unhashable parameter values are sent without caching the response
+        self.api.search_url("https://tineye.com/images/meloncat.jpg", tags=["a"])
+        self.api.search_url("https://tineye.com/images/meloncat.jpg", tags=["a"])
+        self.assertEqual(self.api.http_pool.request.call_count, 6)
+
+        # Every caller gets its own copy of a cached response
+        response.read.return_value = (
+            b'{"code": 200, "results": {"matches": []}, "stats": {"total_results": 0}}'
+        )
+        r = self.api.search_url("https://tineye.com/images/tineye_logo_big.png")
+        r.stats["total_results"] = 123
+        r = self.api.search_url("https://tineye.com/images/tineye_logo_big.png")
+        self.assertEqual(r.stats["total_results"], 0)
+        self.assertEqual(self.api.http_pool.request.call_count, 7)
+
+        # Remaining searches are only cached when a TTL is given
+        response.read.return_value = (
+            b'{"code": 200, "results": {"total_remaining_searches": 0, "bundles": []}}'
+        )
+        self.api.remaining_searches()
+        self.api.remaining_searches()
+        self.assertEqual(self.api.http_pool.request.call_count, 9)
+
+        self.api.remaining_searches_cache_ttl = 5
+        self.addCleanup(setattr, self.api, "remaining_searches_cache_ttl", 0)
+        self.api.remaining_searches()
+        self.api.remaining_searches()
+        self.assertEqual(self.api.http_pool.request.call_count, 10)
+
+    def test_remaining_searches(self):
+        """ Test TinEyeAPIRequest.remaining_searches() date parsing. """
+
+        response = mock_response(
+            b'{"code": 200, "results": {"total_remaining_searches": 7892, '
+            b'"bundles": [{"remaining_searches": 7892, '
+            b'"start_date": "2021-03-10 14:09:12 UTC", '
+            b'"expire_date": "2023-03-09 14:09:12 UTC"}]}}'
+        )
+        self.mock_http_pool()
+        self.api.http_pool.request.return_value = response
+
+        remaining_searches = self.api.remaining_searches()
+        self.assertEqual(remaining_searches["total_remaining_searches"], 7892)
+        bundle = remaining_searches["bundles"][0]
+        self.assertEqual(bundle["remaining_searches"], 7892)
+        self.assertEqual(bundle["start_date"], datetime(2021, 3, 10, 14, 9, 12))
+        self.assertEqual(bundle["expire_date"], datetime(2023, 3, 9, 14, 9, 12))
+
+    def test_search_urls_bulk(self):
+        """ Test TinEyeAPIRequest.search_urls_bulk(). """
+
+        response = mock_response(b'{"code": 200, "results": {"matches": []}}')
+        self.mock_http_pool()
+        self.api.http_pool.request.return_value = response
+
+        urls = ["https://tineye.com/images/%i.jpg" % i for i in range(5)]
+        responses = self.api.search_urls_bulk(urls, max_workers=2, limit=10)
+        self.assertEqual(len(responses), 5)
+        self.assertTrue(all(isinstance(r, TinEyeResponse) for r in responses))
+        self.assertEqual(self.api.http_pool.request.call_count, 5)
+        for call in self.api.http_pool.request.call_args_list:
+            self.assertTrue("limit=10" in call[0][1])
@@ -8,67 +8,159 @@ Test APIRequest class.
 Copyright (c) 2021 TinEye. All rights reserved worldwide.
 """
 
+import random
+import string
 import unittest
+import urllib.parse
 
 from pytineye.api_request import APIRequest
 from pytineye.exceptions import APIRequestError
 
+# Characters a nonce may contain
+ALLOWABLE_NONCE_CHARS = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRTSUVWXYZ0123456789-_=.,*^"
+)
+
+# Messages signed with the private key and their expected HMAC signatures
+HMAC_MESSAGE_CASES = (
+    ("", "70eaf20393eb0605270226d522dfd19d281e64ea513c271c9e6febdd826a5f7c"),
+    (" ", "5f5f7e12a03ce8ac37ef8e98ac77dad52f0d380752ab4928c9e828949eb4e721"),
+    (
+        "this is a message to convert",
+        "a5cb1334a32b5bb43755393be47aea8182a8557097e0f70803dc85b8d4d18562",
+    ),
+    (
+        "this is another message to convert",
+        "ce7c686d266ebeb4e8e9dc1d1cb3d88b72ed8d4f3be41096aa3c397e45ade372",
+    ),
+)
+
+# API method, request parameters and expected signature of GET requests
+HMAC_GET_CASES = (
+    (
+        "image_count",
+        None,
+        "dfc8b4735ab41c907059b473727bd500645f161398133db1c2ebdf276221d681",
+    ),
+    (
+        "remaining_searches",
+        {"param_1": "value"},
+        "3b055b83d6e32f1604328306a51ba9b243f52986ba0458a7915d864d00d2f04e",
+    ),
+)
+
+# API method, request parameters and expected signature of POST requests
+HMAC_POST_CASES = (
+    (
+        "search",
+        None,
+        "26e789aaaf7e3f0b3c2eea15ba385a1e22da6cf93698ec98ea61627c84e35a5e",
+    ),
+    (
+        "search",
+        {"param_1": "value"},
+        "79232caabb7433561142f465cb2e645197bbc5c56a3d3832884d8e24ed128e33",
+    ),
+)
+
+# Request parameters and the sorted query string built from them
+SORT_CASES = (
+    ({}, ""),
+    ({"a_param": "value_1"}, "a_param=value_1"),
+    ({"a_param": "value_1", "b_param": "value_2"}, "a_param=value_1&b_param=value_2"),
+    (
+        {"param_1": "value_1", "a_param": "value_2", "b_param": "value_3"},
+        "a_param=value_2&b_param=value_3&param_1=value_1",
+    ),
+    (
+        {
+            "api_key": "a_key",
+            "param_1": "value_1",
+            "a_param": "value_2",
+            "b_param": "value_3",
+        },
+        "a_param=value_2&b_param=value_3&param_1=value_1",
+    ),
+    (
+        {
+            "api_key": "a_key",
+            "param_1": "value_1",
+            "api_sig": "a_sig",
+            "a_param": "value_2",
+        },
+        "a_param=value_2&param_1=value_1",
+    ),
+    (
+        {"api_key": "a_key", "date": "date", "api_sig": "a_sig", "nonce": "nonce"},
+        "",
+    ),
+    ({"image_url": "valu$_1"}, "image_url=valu%24_1"),
+    ({"image_url": "CAPS!??!?!"}, "image_url=caps%21%3f%3f%21%3f%21"),
+    (
+        {"image_url": "CAPS%21%3f%3f%21%3f%21"},
+        "image_url=caps%2521%253f%253f%2521%253f%2521",
+    ),
+    (
+        {"Image_Url": "CAPS%21%3f%3f%21%3f%21"},
+        "image_url=caps%2521%253f%253f%2521%253f%2521",
+    ),
+    (
+        dict(
+            {"param_%02d" % i: "value_%d" % i for i in range(49, -1, -1)},
+            api_sig="a_sig",
+        ),
+        "&".join("param_%02d=value_%d" % (i, i) for i in range(50)),
+    ),
+)
+
+# Request parameters and the query string that follows the signature
+# in the request URL
+REQUEST_URL_CASES = (
+    ({"a_param": "value_1"}, "a_param=value_1"),
+    (
+        {"param_1": "value_1", "a_param": "value_2", "b_param": "value_3"},
+        "a_param=value_2&b_param=value_3&param_1=value_1",
+    ),
+    ({"image_url": "CAPS?!!?"}, "image_url=CAPS%3F%21%21%3F"),
+)
+
 
 class TestAPIRequest(unittest.TestCase):
     """ Test APIRequest class. """
 
-    def setUp(self):
-        self.request = APIRequest(
+    @classmethod
+    def setUpClass(cls):
+        cls.request = APIRequest(
             "https://api.tineye.com/rest/",
             "LCkn,2K7osVwkX95K4Oy",
             "6mm60lsCNIB,FwOWjJqA80QZHh9BMwc-ber4u=t^",
         )
 
-    def tearDown(self):
-        pass
-
     def test_generate_nonce(self):
         """ Test APIRequest._generate_nonce(). """
 
-        allowable_chars = (
-            "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRTSUVWXYZ0123456789-_=.,*^"
-        )
-
-        self.assertRaises(
-            APIRequestError, lambda: self.request._generate_nonce(nonce_length=-1)
-        )
-        self.assertRaises(
-            APIRequestError, lambda: self.request._generate_nonce(nonce_length=0)
-        )
-        self.assertRaises(
-            APIRequestError, lambda: self.request._generate_nonce(nonce_length=23)
-        )
-
-        try:
-            self.request._generate_nonce(nonce_length=0)
-        except APIRequestError as e:
-            self.assertEqual(
-                e.args[0], "Nonce length must be an int between 24 and 255 chars"
-            )
-
-        try:
-            self.request._generate_nonce(nonce_length="character")
-        except APIRequestError as e:
-            self.assertEqual(
-                e.args[0], "Nonce length must be an int between 24 and 255 chars"
-            )
-
-        nonce = self.request._generate_nonce(nonce_length=24)
-        self.assertEqual(len(nonce), 24)
-
-        for char in nonce:
-            self.assertTrue(char in allowable_chars)
-
-        nonce = self.request._generate_nonce(nonce_length=36)
-        self.assertEqual(len(nonce), 36)
-
-        for char in nonce:
-            self.assertTrue(char in allowable_chars)
+        for nonce_length in (-1, 0, 23, "character"):
+            with self.subTest(nonce_length=nonce_length):
+                with self.assertRaisesRegex(
+                    APIRequestError,
+                    "^Nonce length must be an int between 24 and 255 chars$",
+                ):
+                    self.request._generate_nonce(nonce_length=nonce_length)
+
+        for nonce_length in (24, 25, 36, 64, 128, 255):
+            with self.subTest(nonce_length=nonce_length):
+                nonce = self.request._generate_nonce(nonce_length=nonce_length)
+                self.assertEqual(len(nonce), nonce_length)
+                self.assertFalse(set(nonce) - ALLOWABLE_NONCE_CHARS, nonce)
+
+    def test_generate_boundary(self):
+        """ Test APIRequest._generate_boundary(). """
+
+        boundary = self.request._generate_boundary()
+        self.assertEqual(len(boundary), 49)
+        self.assertTrue(boundary.startswith("-" * 15))
+        self.assertTrue(boundary.endswith("--"))
+        self.assertNotEqual(boundary, self.request._generate_boundary())
 
     def test_generate_hmac_signature(self):
         """
@@ -77,143 +169,106 @@ class TestAPIRequest(unittest.TestCase):
         TestAPIRequest._generate_hmac_signature().
         """
 
-        signature = self.request._generate_hmac_signature("")
-        self.assertEqual(
-            signature,
-            "70eaf20393eb0605270226d522dfd19d281e64ea513c271c9e6febdd826a5f7c",
-        )
-
-        signature = self.request._generate_hmac_signature(" ")
-        self.assertEqual(
-            signature,
-            "5f5f7e12a03ce8ac37ef8e98ac77dad52f0d380752ab4928c9e828949eb4e721",
-        )
-
-        signature = self.request._generate_hmac_signature(
-            "this is a message to convert"
-        )
-        self.assertEqual(
-            signature,
-            "a5cb1334a32b5bb43755393be47aea8182a8557097e0f70803dc85b8d4d18562",
-        )
-
-        signature = self.request._generate_hmac_signature(
-            "this is another message to convert"
-        )
-        self.assertEqual(
-            signature,
-            "ce7c686d266ebeb4e8e9dc1d1cb3d88b72ed8d4f3be41096aa3c397e45ade372",
-        )
+        for message, expected in HMAC_MESSAGE_CASES:
+            with self.subTest(message=message):
+                signature = self.request._generate_hmac_signature(message)
+                self.assertEqual(signature, expected)
 
         nonce = "a_nonce"
         date = 1347910390
-        signature = self.request._generate_get_hmac_signature(
-            "image_count", nonce, date
-        )
-        self.assertEqual(
-            signature,
-            "dfc8b4735ab41c907059b473727bd500645f161398133db1c2ebdf276221d681",
-        )
-
-        signature = self.request._generate_get_hmac_signature(
-            "remaining_searches", nonce, date, request_params={"param_1": "value"}
-        )
-        self.assertEqual(
-            signature,
-            "3b055b83d6e32f1604328306a51ba9b243f52986ba0458a7915d864d00d2f04e",
-        )
+        for method, request_params, expected in HMAC_GET_CASES:
+            with self.subTest(method=method, request_params=request_params):
+                signature = self.request._generate_get_hmac_signature(
+                    method, nonce, date, request_params=request_params
+                )
+                self.assertEqual(signature, expected)
 
         boundary = "--boundary!"
-        signature = self.request._generate_post_hmac_signature(
-            "search", boundary, nonce, date, filename="file"
-        )
+        for method, request_params, expected in HMAC_POST_CASES:
+            with self.subTest(method=method, request_params=request_params):
+                signature = self.request._generate_post_hmac_signature(
+                    method,
+                    boundary,
+                    nonce,
+                    date,
+                    filename="file",
+                    request_params=request_params,
+                )
+                self.assertEqual(signature, expected)
+
+    def test_private_key(self):
+        """ Test that changing APIRequest.private_key changes the signing key. """
+
+        request = APIRequest("https://api.tineye.com/rest/", "public_key", "old_key")
+        request.private_key = "new_key"
+        self.assertEqual(request.private_key, "new_key")
+
+        expected = APIRequest("https://api.tineye.com/rest/", "public_key", "new_key")
         self.assertEqual(
-            signature,
-            "26e789aaaf7e3f0b3c2eea15ba385a1e22da6cf93698ec98ea61627c84e35a5e",
-        )
-
-        signature = self.request._generate_post_hmac_signature(
-            "search",
-            boundary,
-            nonce,
-            date,
-            filename="file",
-            request_params={"param_1": "value"},
+            request._generate_hmac_signature("message"),
+            expected._generate_hmac_signature("message"),
         )
         self.assertEqual(
-            signature,
-            "79232caabb7433561142f465cb2e645197bbc5c56a3d3832884d8e24ed128e33",
+            request._generate_get_hmac_signature("search", "a_nonce", 1347910390),
+            expected._generate_get_hmac_signature("search", "a_nonce", 1347910390),
         )
 
-    def test_sort_params(self):
-        """ Test APIRequest._sort_params(). """
-
-        request_params = {}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "")
-
-        request_params = {"a_param": "value_1"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "a_param=value_1")
+    def test_api_url(self):
+        """ Test that changing APIRequest.api_url changes the request URLs. """
 
-        request_params = {"a_param": "value_1", "b_param": "value_2"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "a_param=value_1&b_param=value_2")
-
-        request_params = {
-            "param_1": "value_1",
-            "a_param": "value_2",
-            "b_param": "value_3",
-        }
-        sorted_params = self.request._sort_params(request_params)
+        request = APIRequest("https://api.tineye.com/rest/", "", "private_key")
         self.assertEqual(
-            sorted_params, "a_param=value_2&b_param=value_3&param_1=value_1"
+            request._request_url("search", "a_nonce", 1, "api_sig", {}),
+            "https://api.tineye.com/rest/search/?",
         )
 
-        request_params = {
-            "api_key": "a_key",
-            "param_1": "value_1",
-            "a_param": "value_2",
-            "b_param": "value_3",
-        }
-        sorted_params = self.request._sort_params(request_params)
+        request.api_url = "https://example.com/rest/"
+        self.assertEqual(request.api_url, "https://example.com/rest/")
         self.assertEqual(
-            sorted_params, "a_param=value_2&b_param=value_3&param_1=value_1"
+            request._request_url("search", "a_nonce", 1, "api_sig", {}),
+            "https://example.com/rest/search/?",
         )
 
-        request_params = {
-            "api_key": "a_key",
-            "param_1": "value_1",
-            "api_sig": "a_sig",
-            "a_param": "value_2",
-        }
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "a_param=value_2&param_1=value_1")
-
-        request_params = {
-            "api_key": "a_key",
-            "date": "date",
-            "api_sig": "a_sig",
-            "nonce": "nonce",
-        }
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "")
-
-        request_params = {"image_url": "valu$_1"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "image_url=valu%24_1")
-
-        request_params = {"image_url": "CAPS!??!?!"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "image_url=caps%21%3f%3f%21%3f%21")
-
-        request_params = {"image_url": "CAPS%21%3f%3f%21%3f%21"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "image_url=caps%2521%253f%253f%2521%253f%2521")
+    def test_sort_params(self):
+        """ Test APIRequest._sort_params(). """
 
-        request_params = {"Image_Url": "CAPS%21%3f%3f%21%3f%21"}
-        sorted_params = self.request._sort_params(request_params)
-        self.assertEqual(sorted_params, "image_url=caps%2521%253f%253f%2521%253f%2521")
+        for request_params, expected in SORT_CASES:
+            with self.subTest(request_params=request_params):
+                sorted_params = self.request._sort_params(request_params)
+                self.assertEqual(sorted_params, expected)
+
+    def test_sort_params_invariants(self):
+        """ Test APIRequest._sort_params() on randomly generated parameters. """
+
+        rng = random.Random(0)
+        names = list(APIRequest.special_params) + [
+            "".join(rng.choice(string.ascii_letters + "_") for _ in range(5))
+            for _ in range(20)
+        ]
+
+        for _ in range(200):
+            request_params = {
+                rng.choice(names): "".join(
+                    rng.choice(string.ascii_letters + string.digits)
+                    for _ in range(rng.randrange(10))
+                )
+                for _ in range(rng.randrange(10))
+            }
+            with self.subTest(request_params=request_params):
+                sorted_params = self.request._sort_params(request_params)
+                params = [p.split("=", 1) for p in sorted_params.split("&") if p]
+                param_names = [name for name, _ in params]
+
+                self.assertEqual(param_names, sorted(param_names))
+                self.assertFalse(set(param_names) & APIRequest.special_params)
+                self.assertEqual(
+                    sorted(map(tuple, params)),
+                    sorted(
+                        (name.lower(), value)
+                        for name, value in request_params.items()
+                        if name.lower() not in APIRequest.special_params
+                    ),
+                )
 
     def test_request_url(self):
         """ Test APIRequest._request_url(). """
@@ -221,39 +276,35 @@ class TestAPIRequest(unittest.TestCase):
         nonce = "a_nonce"
         date = 1345821763
 
-        url = self.request._request_url(
-            "search", nonce, date, "api_sig", {"a_param": "value_1"}
-        )
-        self.assertEqual(
-            url,
-            (
-                "https://api.tineye.com/rest/search/?api_key=LCkn,2K7osVwkX95K4Oy&date=1345821763"
-                "&nonce=a_nonce&api_sig=api_sig&a_param=value_1"
-            ),
-        )
+        for request_params, expected in REQUEST_URL_CASES:
+            with self.subTest(request_params=request_params):
+                url = self.request._request_url(
+                    "search", nonce, date, "api_sig", request_params
+                )
+                self.assertEqual(
+                    url,
+                    (
+                        "https://api.tineye.com/rest/search/?api_key=LCkn,2K7osVwkX95K4Oy&date=1345821763"
+                        "&nonce=a_nonce&api_sig=api_sig&%s" % expected
+                    ),
+                )
+
+    def test_get_request(self):
+        """ Test APIRequest.get_request() signs the URL it returns. """
+
+        url = self.request.get_request("search", {"image_url": "CAPS?!!?", "limit": 10})
+        base_url, query = url.split("?", 1)
+        self.assertEqual(base_url, "https://api.tineye.com/rest/search/")
+
+        query_params = dict(urllib.parse.parse_qsl(query))
+        self.assertEqual(query_params["api_key"], "LCkn,2K7osVwkX95K4Oy")
+        self.assertEqual(query_params["image_url"], "CAPS?!!?")
+        self.assertEqual(query_params["limit"], "10")
 
-        url = self.request._request_url(
+        signature = self.request._generate_get_hmac_signature(
             "search",
-            nonce,
-            date,
-            "api_sig",
-            {"param_1": "value_1", "a_param": "value_2", "b_param": "value_3"},
-        )
-        self.assertEqual(
-            url,
-            (
-                "https://api.tineye.com/rest/search/?api_key=LCkn,2K7osVwkX95K4Oy&date=1345821763"
-                "&nonce=a_nonce&api_sig=api_sig&a_param=value_2&b_param=value_3&param_1=value_1"
-            ),
-        )
-
-        url = self.request._request_url(
-            "search", nonce, date, "api_sig", {"image_url": "CAPS?!!?"}
-        )
-        self.assertEqual(
-            url,
-            (
-                "https://api.tineye.com/rest/search/?api_key=LCkn,2K7osVwkX95K4Oy&date=1345821763"
-                "&nonce=a_nonce&api_sig=api_sig&image_url=CAPS%3F%21%21%3F"
-            ),
+            query_params["nonce"],
+            int(query_params["date"]),
+            request_params={"image_url": "CAPS?!!?", "limit": 10},
         )
+        self.assertEqual(query_params["api_sig"], signature)
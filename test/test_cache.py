@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_cache.py
+
+Test ResponseCache class.
+
+Copyright (c) 2021 TinEye. All rights reserved worldwide.
+"""
+
+import time
+import unittest
+
+from pytineye.cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    """ Test ResponseCache class. """
+
+    def test_get_set(self):
+        """ Test ResponseCache.get() and ResponseCache.set(). """
+
+        cache = ResponseCache(maxsize=2)
+        self.assertEqual(cache.get("a"), None)
+
+        cache.set("a", 1, ttl=60)
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.set("b", 2, ttl=0)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(len(cache), 1)
+
+        cache.clear()
+        self.assertEqual(cache.get("a"), None)
+
+    def test_expiry(self):
+        """ Test that entries expire after their TTL. """
+
+        cache = ResponseCache()
+        cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        """ Test that the least recently used entry is evicted first. """
+
+        cache = ResponseCache(maxsize=2)
+        cache.set("a", 1, ttl=60)
+        cache.set("b", 2, ttl=60)
+        cache.get("a")
+        cache.set("c", 3, ttl=60)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+
+        cache = ResponseCache(maxsize=0)
+        cache.set("a", 1, ttl=60)
+        self.assertEqual(cache.get("a"), None)